@@ -33,6 +33,9 @@ class config(object):
     # 映射表保存位置
     links_map_directory = 'links_map'
 
+    # 只处理这些id的文档(如WikiExtractor --incremental输出的changed.txt),None则处理全部
+    changed_docs = None
+
     # 所有正则
     # 匹配文档的开头
     docRE = re.compile(r'<doc id="(\d+)" url="(.*?)" title="(.*?)">')
@@ -557,6 +560,8 @@ def Parse(file, output_directory, reduce_page_number, process_start_time):
     for page_data in pages_from(input):
         # 将取出的文件解开
         id, title, url, text = page_data
+        if config.changed_docs is not None and id not in config.changed_docs:
+            continue
         text = [text]  # 参数传递改为地址传参
         logging.info("id: %s, title: %s", id, title)
 
@@ -667,6 +672,9 @@ def main():
                         help="Number of processes to use (default %(default)s)")
     groupS.add_argument("-f", "--filesingle", action="store_true",
                         help="analyze a single file outputted by WikiExtractor(debug option)")
+    groupS.add_argument("--changed", metavar="FILE",
+                        help="process only the documents whose id is listed in FILE, as the changed.txt"
+                        " of WikiExtractor --incremental")
     args = parser.parse_args()
 
     input_directory = args.input
@@ -691,6 +699,11 @@ def main():
             logging.error('Could not create: %s', output_directory)
             return
 
+    # 只处理有变化的文档
+    if args.changed:
+        with open(args.changed) as f:
+            config.changed_docs = set(line.strip() for line in f)
+
     # 保存映射表的位置
     if not os.path.isdir(config.links_map_directory):
         try:
@@ -17,6 +17,7 @@ import bz2
 import codecs
 import cgi
 import fileinput
+import io
 import logging
 import os.path
 import re  # TODO use regex when it will be standard
@@ -51,6 +52,7 @@ version = '2.66'
 
 ReTag_sectiontitle = re.compile(r'<h(\d+)>([^<]*?)</h\1>') #<h3>Spanish Revolution</h3>
 ReTag_doctitle = re.compile(r'(?:<doc id="[^>]*?">)|(?:</doc>)')#<doc id="12" url="https://en.wikipedia.org/wiki?curid=12" title="Anarchism">
+ReTag_docid = re.compile(r'<doc id="(\d+)"')#<doc id="12" url=...
 ReTag_categoryline = re.compile(r'\[\[Category:[^\]]*?\]\]')#[[Category:Anarchism|]]
 
 ReTag_wikilinkpostfix = re.compile(r'\[\[([^\]\[]*?)\]\]([\'_—–\-\w]+)') #[[Spanish|Communist Party]]-led
@@ -85,6 +87,71 @@ ReTag_tokenizebug2 = re.compile(r':\[ \[')
 ReTag_nowiki= re.compile(r'<nowiki>(.*?)</nowiki>')#<nowiki>to [buy [a car]]</nowiki>
 
 
+class BZ2StreamsFile(io.RawIOBase):
+    """
+    Reads a file of concatenated bz2 streams, as written by WikiExtractor with
+    --compress, whose blocks are compressed separately by its processes.
+    bz2.BZ2File of Python 2 would stop at the end of the first stream.
+    """
+
+    def __init__(self, filename, chunk_size=1024 * 1024):
+        self.file = open(filename, 'rb')
+        self.chunk_size = chunk_size
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = b''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos == len(self.buffer):
+            data = self.decompressor.unused_data
+            if data:            # the next stream starts there
+                self.decompressor = bz2.BZ2Decompressor()
+            else:
+                data = self.file.read(self.chunk_size)
+                if not data:
+                    return 0
+            try:
+                self.buffer = self.decompressor.decompress(data)
+            except EOFError:    # the stream ended with the previous chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                self.buffer = self.decompressor.decompress(data)
+            self.pos = 0
+        n = min(len(b), len(self.buffer) - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.file.close()
+        super(BZ2StreamsFile, self).close()
+
+
+##
+# ids of the documents to parse, e.g. changed.txt of WikiExtractor --incremental,
+# or None to parse all
+changedDocs = None
+
+
+def load_changed(filename):
+    """
+    :return: the set of ids in :param filename:, one per line.
+    """
+    with open(filename, 'rb') as f:
+        return set(line.decode('utf-8').strip() for line in f)
+
+
+def hook_compressed(filename, mode):
+    """
+    Like fileinput.hook_compressed(), but reading all the streams of .bz2 files.
+    """
+    if os.path.splitext(filename)[1] == '.bz2':
+        return io.BufferedReader(BZ2StreamsFile(filename), 1024 * 1024)
+    return fileinput.hook_compressed(filename, mode)
+
+
 def Parse(input_file, output_file):
     '''
     Parese the data in inputfile, and save the result into outputfile
@@ -92,7 +159,7 @@ def Parse(input_file, output_file):
                       The formattion of the file should be as Lustyle
     :param outputfile: the outputfile, which has been opened or std.out
     '''
-    inputfile = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+    inputfile = fileinput.FileInput(input_file, openhook=hook_compressed)
         
     if output_file == 'text': #this means default value of '--output'
         outputfile = sys.stdout
@@ -100,8 +167,15 @@ def Parse(input_file, output_file):
         outputfile = open(output_file,'w')    
     
     lineno = 1
+    keep = True         # whether the current document is in changedDocs
     
     for line in inputfile:      
+        if changedDocs is not None:
+            m = ReTag_docid.match(line.decode('utf-8'))
+            if m:
+                keep = m.group(1) in changedDocs
+            if not keep:
+                continue
         if lineno == 1:
             if outputfile == sys.stdout:
                 print '=========================================',
@@ -683,6 +757,7 @@ def ParseOneLine(oldline, inputfile):
 
 
 def main():
+    global changedDocs
     print 'this is main function'
     
     parser = argparse.ArgumentParser(prog=os.path.basename(sys.argv[0]),
@@ -708,11 +783,16 @@ def main():
                         help="print debug info")
     groupS.add_argument("-f", "--filesingle", action="store_true",
                         help="analyze a single file outputted by WikiExtractor(debug option)")
+    groupS.add_argument("--changed", metavar="FILE",
+                        help="parse only the documents whose id is listed in FILE, as the changed.txt"
+                        " of WikiExtractor --incremental")
     groupS.add_argument("-v", "--version", action="version",
                         version='%(prog)s ' + version,
                         help="print program version")
                         
     args = parser.parse_args()    
+    if args.changed:
+        changedDocs = load_changed(args.changed)
 
     FORMAT = '%(levelname)s: %(message)s'
     logging.basicConfig(format=FORMAT)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the line scanner (pages_from) with the byte scanner (pages_from_bytes)
+of WikiExtractor on a dump, checking that both yield the same pages.
+
+Usage:
+  bench_pages_from.py enwiki-20161001-pages-articles.xml [--repeat 3]
+"""
+
+from __future__ import print_function
+
+import argparse
+import fileinput
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import WikiExtractor
+
+
+def timed(scanner, input_file, repeat):
+    best = None
+    pages = None
+    for _ in range(repeat):
+        input = fileinput.hook_compressed(input_file, 'rb')
+        start = time.time()
+        pages = list(scanner(input))
+        elapsed = time.time() - start
+        input.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="XML wiki dump file (.xml or .bz2)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per scanner, the best one is reported (default=%(default)s)")
+    args = parser.parse_args()
+
+    line_time, line_pages = timed(WikiExtractor.pages_from, args.input, args.repeat)
+    byte_time, byte_pages = timed(WikiExtractor.pages_from_bytes, args.input, args.repeat)
+
+    size = os.path.getsize(args.input) / 1024.0 / 1024.0
+    print("pages: %d, file size: %.1f MB" % (len(line_pages), size))
+    print("pages_from:       %.3fs (%.1f MB/s)" % (line_time, size / line_time))
+    print("pages_from_bytes: %.3fs (%.1f MB/s)" % (byte_time, size / byte_time))
+    print("speedup: %.2fx" % (line_time / byte_time))
+
+    if line_pages != byte_pages:
+        for i, (a, b) in enumerate(zip(line_pages, byte_pages)):
+            if a != b:
+                print("mismatch at page %d: %r != %r" % (i, a[:3], b[:3]))
+                break
+        else:
+            print("mismatch in page count: %d != %d" % (len(line_pages), len(byte_pages)))
+        sys.exit(1)
+    print("outputs identical")
+
+
+if __name__ == '__main__':
+    main()
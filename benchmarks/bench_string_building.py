@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares building the rewritten text of an article by repeated string
+concatenation with the join-once builder (replaceSpans) of WikiExtractor,
+on a synthetic article with many links, checking that both give the same text.
+
+Usage:
+  bench_string_building.py [--size 5] [--links 50000] [--repeat 3]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import WikiExtractor
+from WikiExtractor import findBalanced, tailRE, makeInternalLink_lustyle
+
+
+def dropSpans_concat(spans, text):
+    """dropSpans, building its result by concatenation."""
+    spans.sort()
+    res = ''
+    offset = 0
+    for s, e in spans:
+        if offset <= s:
+            if offset < s:
+                res += text[offset:s]
+            offset = e
+    res += text[offset:]
+    return res
+
+
+def replaceInternalLinks_concat(text):
+    """replaceInternalLinks_lustyle, building its result by concatenation."""
+    cur = 0
+    res = ''
+    for s, e in findBalanced(text):
+        m = tailRE.match(text, e)
+        if m:
+            trail = m.group(0)
+            end = m.end()
+        else:
+            trail = ''
+            end = e
+        inner = text[s + 2:e - 2]
+        pipe = inner.find('|')
+        if pipe < 0:
+            title = inner
+            label = title
+        else:
+            title = inner[:pipe].rstrip()
+            curp = pipe + 1
+            for s1, e1 in findBalanced(inner):
+                last = inner.rfind('|', curp, s1)
+                if last >= 0:
+                    pipe = last
+                curp = e1
+            label = inner[pipe + 1:].strip()
+        res += text[cur:s] + makeInternalLink_lustyle(title, label) + trail
+        cur = end
+    return res + text[cur:]
+
+
+def article(size, links, seed=1):
+    """A synthetic article of about :param size: bytes with :param links: links."""
+    r = random.Random(seed)
+    words = 'river mountain city empire kingdom war battle treaty music album'.split()
+    filler = max(1, (size // links) // 7)
+    parts = []
+    for i in range(links):
+        parts.append(' '.join(r.choice(words) for _ in range(filler)))
+        if i % 3:
+            parts.append(' [[%s %d|%s]]s ' % (r.choice(words), i, r.choice(words)))
+        else:
+            parts.append(' [[%s %d]] ' % (r.choice(words), i))
+    return ''.join(parts)
+
+
+def timed(function, repeat, *args):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def compare(name, reference, current, repeat, *args):
+    ref_time, ref_text = timed(reference, repeat, *args)
+    cur_time, cur_text = timed(current, repeat, *args)
+    print("%-22s concat: %.3fs  join: %.3fs  speedup: %.2fx"
+          % (name, ref_time, cur_time, ref_time / cur_time))
+    return ref_text == cur_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=float, default=5,
+                        help="article size in MB (default=%(default)s)")
+    parser.add_argument("--links", type=int, default=50000,
+                        help="number of links in the article (default=%(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per function, the best one is reported (default=%(default)s)")
+    args = parser.parse_args()
+
+    WikiExtractor.Extractor.keepLinks = True
+    text = article(int(args.size * 1024 * 1024), args.links)
+    print("article: %.1f MB, %d links" % (len(text) / 1024.0 / 1024.0, args.links))
+
+    same = compare('replaceInternalLinks', replaceInternalLinks_concat,
+                   WikiExtractor.replaceInternalLinks_lustyle, args.repeat, text)
+    spans = [(s, e) for s, e in findBalanced(text)]
+    same &= compare('dropSpans', lambda: dropSpans_concat(list(spans), text),
+                    lambda: WikiExtractor.dropSpans(list(spans), text), args.repeat)
+    if not same:
+        print("outputs differ")
+        sys.exit(1)
+    print("outputs identical")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks the cleanup of Extractor.clean (placeholders and the rules of
+cleanupRewriter) against a corpus of golden outputs, produced by the former
+sequence of replacements, and reports how many times each rule fired.
+
+Usage:
+  check_clean.py [--corpus clean_golden.jsonl]
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import WikiExtractor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'clean_golden.jsonl'),
+                        help="JSON lines with input and output (default=%(default)s)")
+    args = parser.parse_args()
+
+    cases = 0
+    failures = 0
+    with io.open(args.corpus, encoding='utf-8') as f:
+        for line in f:
+            case = json.loads(line)
+            text = WikiExtractor.expandPlaceholders(case['input'])
+            text = WikiExtractor.cleanupRewriter.sub(text)
+            cases += 1
+            if text != case['output']:
+                failures += 1
+                print("mismatch on %r:\n  expected %r\n  got      %r"
+                      % (case['input'][:200], case['output'][:200], text[:200]))
+
+    for name, hits in WikiExtractor.cleanupRewriter.hits.items():
+        print("%-20s %d" % (name, hits))
+    print("cases: %d, failures: %d" % (cases, failures))
+    if failures:
+        sys.exit(1)
+    print("outputs identical")
+
+
+if __name__ == '__main__':
+    main()
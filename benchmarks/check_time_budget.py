@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Checks that article_time_budget interrupts an article whose time goes into
+a parser function, {{#if:}} made slow here, and that the article is then
+extracted without expanding templates.
+
+Usage:
+  check_time_budget.py [--budget 0.2] [--delay 2]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import os
+import signal
+import sys
+from io import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import WikiExtractor
+from WikiExtractor import Extractor, cpu_time, extract_within, time_budget_exceeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=0.2,
+                        help="CPU seconds per article (default=%(default)s)")
+    parser.add_argument("--delay", type=float, default=2,
+                        help="CPU seconds taken by each {{#if:}} (default=%(default)s)")
+    args = parser.parse_args()
+
+    sharp_if = WikiExtractor.parserFunctions['#if']
+
+    def slow_if(extr, *params):
+        end = cpu_time() + args.delay
+        while cpu_time() < end:
+            pass
+        return sharp_if(extr, *params)
+
+    WikiExtractor.parserFunctions['#if'] = slow_if
+    signal.signal(signal.SIGPROF, time_budget_exceeded)
+    job = ('1', '2', 'Slow', ['Some {{#if:x|first}} and {{#if:y|second}} call.\n'])
+    out = StringIO()
+    start = cpu_time()
+    outcome = extract_within(Extractor(), job, out, args.budget)
+    elapsed = cpu_time() - start
+    print("outcome %s, elapsed %.2fs" % (outcome, elapsed))
+    if outcome != 'fallback' or elapsed > args.delay or 'call' not in out.getvalue():
+        print("the budget was not enforced")
+        sys.exit(1)
+    print("budget enforced")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Generates a synthetic MediaWiki dump, the same for the same seed, to
+benchmark WikiExtractor without a real dump. It has a siteinfo with
+namespaces, templates with nesting and parser functions, modules, articles
+with links, refs, tables, lists, images, nowiki, math and categories,
+redirects, disambiguation, list and date pages, category and talk pages.
+Article lengths have a long tail, as in Wikipedia.
+
+Usage:
+  gen_dump.py dump.xml [--pages 20000] [--seed 1]
+  gen_dump.py dump.xml.bz2 --multistream [--per_stream 100]
+"""
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import bz2
+import io
+import random
+
+WORDS = ('time person year way day thing man world life hand part child eye '
+         'woman place work week case point government company number group '
+         'problem fact river mountain city empire kingdom war battle treaty '
+         'music album song band language system theory science history law '
+         'church school university station railway island province county').split()
+STOPWORDS = ('the of and to in a is that for it as was with be by on not he i this '
+             'are or his from at which but have an they you were her she there one '
+             'all we their been has when who will more no if out so said what up').split()
+
+# templates expanded by the articles, some calling others
+TEMPLATES = [
+    ('Template:Convert', '{{{1}}} {{{2}}}{{#if:{{{abbr|}}}|&nbsp;({{{2}}})}}'
+     '<noinclude>[[Category:Conversion templates]]</noinclude>'),
+    ('Template:Lang', '<includeonly>{{{2}}}</includeonly><noinclude>doc</noinclude>'),
+    ('Template:Infobox thing', '{| class="infobox"\n'
+     '{{Infobox/row|Name|{{{name|}}}}}\n'
+     '{{Infobox/row|Type|{{#switch:{{{type|}}}|a=Alpha|b=Beta|#default={{{type|}}}}}}}\n'
+     '{{Infobox/row|Size|{{{size|}}}}}\n'
+     '{{Infobox/row|Area|{{#expr:{{{size|1}}}*{{{size|1}}}}} m²}}\n|}'),
+    ('Template:Infobox/row', '{{#if:{{{2|}}}|\n|-\n! {{{1}}}\n{{!}} {{{2}}}}}'),
+    ('Template:!', '|'),
+    ('Template:Cite web', '{{{title|}}} {{#if:{{{url|}}}|[{{{url}}}]}}'
+     '{{#ifeq:{{{lang|en}}}|en||&#32;(in {{{lang}}})}}'),
+    ('Template:Reflist', '<div class="reflist">{{{1|}}}</div>'),
+    ('Template:Main article', 'Main article: [[{{{1}}}]]{{#if:{{{2|}}}| and [[{{{2}}}]]}}'),
+    ('Template:As of', 'As of {{#switch:{{{2|}}}|1=January|2=February|3=March|#default=month {{{2|}}}}} {{{1}}}'),
+    ('Template:Disambiguation', "''This disambiguation page lists articles with the same title.''"
+     '[[Category:Disambiguation pages]]'),
+    ('Template:Redir', '#REDIRECT [[Template:Convert]]'),
+    ('Module:String', 'local p = {}\nreturn p'),
+]
+
+HEADER = '''<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>enwiki</dbname>
+    <base>https://en.wikipedia.org/wiki/Main_Page</base>
+    <generator>MediaWiki 1.28.0-wmf.20</generator>
+    <case>first-letter</case>
+    <namespaces>
+      <namespace key="-2" case="first-letter">Media</namespace>
+      <namespace key="0" case="first-letter" />
+      <namespace key="1" case="first-letter">Talk</namespace>
+      <namespace key="6" case="first-letter">File</namespace>
+      <namespace key="10" case="first-letter">Template</namespace>
+      <namespace key="14" case="first-letter">Category</namespace>
+      <namespace key="828" case="first-letter">Module</namespace>
+    </namespaces>
+  </siteinfo>
+'''
+
+FOOTER = '</mediawiki>\n'
+
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+class DumpGenerator(object):
+    """
+    Generates the pages of a dump from a seed.
+    """
+
+    def __init__(self, pages, seed=1):
+        """
+        :param pages: number of pages, besides templates and modules.
+        :param seed: of the random generator.
+        """
+        self.random = random.Random(seed)
+        self.pages = pages
+        self.titles = []        # of the articles so far, for links and redirects
+        self.categories = []
+
+    # random() gives the same numbers in Python 2 and 3, choice() and randint() do not
+
+    def choice(self, items):
+        return items[int(self.random.random() * len(items))]
+
+    def randint(self, a, b):
+        return a + int(self.random.random() * (b - a + 1))
+
+    def word(self):
+        if self.random.random() < 0.45:
+            return self.choice(STOPWORDS)
+        return self.choice(WORDS)
+
+    def title(self):
+        return ' '.join(self.word() for _ in range(self.randint(1, 3))).capitalize()
+
+    def sentence(self):
+        r = self.random
+        parts = []
+        for _ in range(self.randint(6, 20)):
+            x = r.random()
+            if x < 0.08 and self.titles:
+                title = self.choice(self.titles)
+                if r.random() < 0.5:
+                    parts.append('[[%s]]' % title)
+                else:
+                    parts.append('[[%s|%s]]' % (title, self.word()))
+            elif x < 0.10:
+                parts.append("'''%s'''" % self.word())
+            elif x < 0.12:
+                parts.append("''%s''" % self.word())
+            elif x < 0.13:
+                parts.append('<ref>{{cite web|url=http://example.org/%d|title=%s|lang=%s}}</ref>'
+                             % (self.randint(1, 999), self.word(), self.choice(['en', 'fr'])))
+            elif x < 0.14:
+                parts.append('{{convert|%d|km|abbr=on}}' % self.randint(1, 900))
+            elif x < 0.15:
+                parts.append('[http://example.com/%d %s %s]' % (self.randint(1, 99), self.word(), self.word()))
+            elif x < 0.16:
+                parts.append('<!-- %s %s -->' % (self.word(), self.word()))
+            elif x < 0.165:
+                parts.append('<nowiki>{{%s}}</nowiki>' % self.word())
+            elif x < 0.17:
+                parts.append('<math>x^%d</math>' % self.randint(2, 9))
+            elif x < 0.18:
+                parts.append('{{As of|%d|%d}}' % (self.randint(1990, 2016), self.randint(1, 12)))
+            elif x < 0.19:
+                parts.append('{{lang|fr|%s}}' % self.word())
+            elif x < 0.195:
+                parts.append('&nbsp;')
+            else:
+                parts.append(self.word())
+        return ' '.join(parts).capitalize() + '.'
+
+    def table(self):
+        rows = ['{| class="wikitable"', '|-', '! %s !! %s !! %s' % (self.word(), self.word(), self.word())]
+        for _ in range(self.randint(2, 12)):
+            rows.append('|-')
+            rows.append('| %s || {{convert|%d|m}} || [[%s]]'
+                        % (self.word(), self.randint(1, 999), self.choice(self.titles or ['Time'])))
+        rows.append('|}')
+        return '\n'.join(rows)
+
+    def article(self, short=False):
+        r = self.random
+        out = []
+        if r.random() < 0.5:
+            out.append('{{Infobox thing\n| name = %s\n| size = %d\n| type = %s\n}}'
+                       % (self.word(), self.randint(1, 99), self.choice(['a', 'b', self.title()])))
+        if short:
+            sections = 1
+        else:
+            # a long tail of long articles
+            sections = min(40, int(r.paretovariate(1.5)) + 1)
+        for i in range(sections):
+            if i and r.random() < 0.6:
+                out.append('== %s ==' % self.title())
+            if r.random() < 0.2:
+                out.append('{{Main article|%s|%s}}' % (self.title(), self.title()))
+            out.append(' '.join(self.sentence() for _ in range(1 if short else self.randint(2, 6))))
+            if r.random() < 0.2:
+                out.append('\n'.join('* %s' % self.sentence() for _ in range(self.randint(2, 5))))
+            if r.random() < 0.1:
+                out.append(self.table())
+            if r.random() < 0.1:
+                out.append('[[File:Pic%d.jpg|thumb|250px|%s]]' % (self.randint(1, 99), self.sentence()))
+        if r.random() < 0.3:
+            out.append('== References ==\n{{Reflist}}')
+        for _ in range(self.randint(0, 4)):
+            if self.categories and r.random() < 0.7:
+                category = self.choice(self.categories)
+            else:
+                category = self.title()
+                self.categories.append(category)
+            link = '[[Category:%s]]' % category
+            if link not in out:
+                out.append(link)
+        return '\n\n'.join(out)
+
+    def __iter__(self):
+        """
+        :return: (id, title, ns, redirect title or None, text) of each page.
+        """
+        r = self.random
+        id = 10
+        for title, text in TEMPLATES:
+            id += 1
+            yield id, title, '828' if title.startswith('Module:') else '10', None, text
+        for i in range(self.pages):
+            id += self.randint(1, 3)
+            x = r.random()
+            if x < 0.1 and self.titles:
+                target = self.choice(self.titles)
+                yield id, '%s %d' % (self.title(), i), '0', target, '#REDIRECT [[%s]]' % target
+            elif x < 0.13:
+                title = self.title() + ' (disambiguation)'
+                yield id, title, '0', None, "'''%s''' may refer to:\n* [[%s]]\n* [[%s]]\n{{Disambiguation}}" \
+                    % (title, self.title(), self.title())
+            elif x < 0.16:
+                title = self.choice(['List of %s' % self.word(), 'January %d' % self.randint(1, 31),
+                                  '%d' % self.randint(1, 2000)])
+                yield id, title, '0', None, self.article(short=True)
+            elif x < 0.18:
+                yield id, 'Talk:' + self.title(), '1', None, self.sentence()
+            elif x < 0.2 and self.categories:
+                yield id, 'Category:' + self.choice(self.categories), '14', None, self.sentence()
+            else:
+                title = '%s %d' % (self.title(), i)
+                text = self.article(short=x < 0.35)
+                self.titles.append(title)
+                yield id, title, '0', None, text
+
+
+def page_xml(id, title, ns, redirect, text):
+    revid = 1000000 + id
+    out = ['  <page>\n', '    <title>%s</title>\n' % escape(title), '    <ns>%s</ns>\n' % ns,
+           '    <id>%d</id>\n' % id]
+    if redirect:
+        out.append('    <redirect title="%s" />\n' % escape(redirect))
+    out.append('    <revision>\n      <id>%d</id>\n      <parentid>%d</parentid>\n'
+               '      <timestamp>2016-10-01T00:00:00Z</timestamp>\n'
+               '      <contributor>\n        <username>Bot</username>\n        <id>4242</id>\n      </contributor>\n'
+               '      <model>wikitext</model>\n      <format>text/x-wiki</format>\n' % (revid, revid - 1))
+    out.append('      <text xml:space="preserve">%s</text>\n' % escape(text))
+    out.append('      <sha1>%040x</sha1>\n    </revision>\n  </page>\n' % revid)
+    return ''.join(out)
+
+
+def generate(output, pages, seed=1, multistream=False, per_stream=100):
+    """
+    Writes a dump of :param pages: pages to :param output:.
+    :param multistream: whether to write a bz2 multistream dump, with its
+        index next to it, as output-index.txt.bz2 for output.xml.bz2.
+    :param per_stream: pages in each bz2 stream.
+    :return: number of pages written.
+    """
+    pages = [page_xml(*page) for page in DumpGenerator(pages, seed)]
+    if not multistream:
+        with io.open(output, 'w', encoding='utf-8') as f:
+            f.write(HEADER)
+            for page in pages:
+                f.write(page)
+            f.write(FOOTER)
+        return len(pages)
+    index = []
+    with open(output, 'wb') as f:
+        f.write(bz2.compress(HEADER.encode('utf-8')))
+        for i in range(0, len(pages), per_stream):
+            offset = f.tell()
+            index.extend('%d:0:x' % offset for _ in pages[i:i + per_stream])
+            f.write(bz2.compress(''.join(pages[i:i + per_stream]).encode('utf-8')))
+        f.write(bz2.compress(FOOTER.encode('utf-8')))
+    with open(output.replace('.xml.bz2', '') + '-index.txt.bz2', 'wb') as f:
+        f.write(bz2.compress(('\n'.join(index) + '\n').encode('utf-8')))
+    return len(pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="dump file to write")
+    parser.add_argument("--pages", type=int, default=20000,
+                        help="number of pages besides templates (default=%(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the random generator (default=%(default)s)")
+    parser.add_argument("--multistream", action="store_true",
+                        help="write a bz2 multistream dump with its index")
+    parser.add_argument("--per_stream", type=int, default=100,
+                        help="pages in each bz2 stream (default=%(default)s)")
+    args = parser.parse_args()
+
+    count = generate(args.output, args.pages, args.seed, args.multistream, args.per_stream)
+    print("wrote %d pages to %s" % (count, args.output))
+
+
+if __name__ == '__main__':
+    main()
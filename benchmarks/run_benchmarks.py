@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs WikiExtractor end to end on a synthetic dump made by gen_dump.py, with
+each combination of the --processes given, --lustyle and --compress, and
+reports pages/s, MB/s of dump and the peak RSS of the largest process.
+
+The results are checked against a baseline, failing when the pages/s of a
+setting fall more than the tolerance below it; --save stores them as the
+baseline instead. Throughput depends on the machine, so the baseline should
+be saved on the machine that checks against it.
+
+Usage:
+  run_benchmarks.py [--pages 5000] [--processes 1,2] [--repeat 3] [--tolerance 0.15]
+  run_benchmarks.py --save
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from gen_dump import generate
+
+here = os.path.dirname(os.path.abspath(__file__))
+extractor = os.path.join(here, '..', 'WikiExtractor.py')
+
+# runs a command and prints its wall time, the peak RSS of its processes and its exit code
+measure = """
+import resource, subprocess, sys, time
+start = time.time()
+code = subprocess.call(sys.argv[1:])
+rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+print('%f %d %d' % (time.time() - start, rss if sys.platform == 'darwin' else rss * 1024, code))
+"""
+
+lustyle_args = ['--lustyle', '--html', '--filter_disambig_pages', '--min_text_length', '100']
+
+
+def settings(process_counts):
+    """
+    :return: (name, arguments) of each setting to run.
+    """
+    for processes in process_counts:
+        for lustyle in (False, True):
+            for compress in (False, True):
+                name = 'p%d' % processes
+                args = ['--processes', str(processes), '--bytes', '1M']
+                if lustyle:
+                    name += '-lustyle'
+                    args += lustyle_args
+                if compress:
+                    name += '-compress'
+                    args.append('--compress')
+                yield name, args
+
+
+def run(dump, args):
+    """
+    Extracts :param dump: with :param args:.
+    :return: (wall seconds, peak RSS in MB).
+    """
+    output = tempfile.mkdtemp(prefix='bench_out_')
+    try:
+        command = [sys.executable, extractor, dump, '-o', output, '-q'] + args
+        out = subprocess.check_output([sys.executable, '-c', measure] + command)
+        wall, rss, code = out.split()
+        if int(code):
+            raise RuntimeError("%s failed with exit code %s" % (' '.join(command), code))
+        return float(wall), int(rss) / 1024.0 / 1024.0
+    finally:
+        shutil.rmtree(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=5000,
+                        help="pages of the synthetic dump (default=%(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed of the synthetic dump (default=%(default)s)")
+    parser.add_argument("--processes", default="1,2",
+                        help="comma separated values of --processes to run with (default=%(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per setting, the fastest one is reported (default=%(default)s)")
+    parser.add_argument("--baseline", default=os.path.join(here, 'baseline.json'),
+                        help="baseline results (default=%(default)s)")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="fraction of the baseline pages/s that may be lost (default=%(default)s)")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the baseline instead of checking them")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save:
+        if not os.path.exists(args.baseline):
+            print("no baseline in %s, run with --save first" % args.baseline)
+            sys.exit(2)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline['pages'], baseline['seed']) != (args.pages, args.seed):
+            print("the baseline was measured on a dump of %d pages with seed %d"
+                  % (baseline['pages'], baseline['seed']))
+            sys.exit(2)
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        dump = os.path.join(workdir, 'dump.xml')
+        pages = generate(dump, args.pages, args.seed)
+        size = os.path.getsize(dump) / 1024.0 / 1024.0
+        print("dump: %d pages, %.1f MB" % (pages, size))
+        print("%-22s %9s %8s %8s %9s" % ('setting', 'pages/s', 'MB/s', 'RSS MB', 'change'))
+
+        results = {}
+        regressions = []
+        for name, extra in settings(int(count) for count in args.processes.split(',')):
+            runs = [run(dump, extra) for _ in range(args.repeat)]
+            wall = min(wall for wall, _ in runs)
+            result = results[name] = {
+                'pages_per_s': round(pages / wall, 1),
+                'mb_per_s': round(size / wall, 2),
+                'peak_rss_mb': round(max(rss for _, rss in runs), 1),
+            }
+            change = ''
+            if baseline and name in baseline['results']:
+                reference = baseline['results'][name]['pages_per_s']
+                ratio = result['pages_per_s'] / reference
+                change = '%+.1f%%' % (100 * (ratio - 1))
+                if ratio < 1 - args.tolerance:
+                    regressions.append(name)
+                    change += ' !'
+            print("%-22s %9.1f %8.2f %8.1f %9s" % (name, result['pages_per_s'], result['mb_per_s'],
+                                                    result['peak_rss_mb'], change))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'pages': args.pages, 'seed': args.seed, 'python': sys.version.split()[0],
+                       'results': results}, f, indent=2, separators=(',', ': '), sort_keys=True)
+            f.write('\n')
+        print("saved baseline to %s" % args.baseline)
+    elif regressions:
+        print("throughput regressed more than %.0f%% in: %s"
+              % (100 * args.tolerance, ', '.join(regressions)))
+        sys.exit(1)
+    else:
+        print("no regression")
+
+
+if __name__ == '__main__':
+    main()